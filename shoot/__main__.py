@@ -4,9 +4,12 @@
 import os
 import re
 import csv
+import shutil
 import argparse
-from collections import defaultdict
+import itertools
+from functools import lru_cache
 
+import flat_tree
 import og_assigner
 import tree_grafter
 import msa_grafter
@@ -15,9 +18,14 @@ import utils
 # import quartets_pairwise_align
 
 import ete3
+import numpy as np
 
 
-gene_name_disallowed_chars_re = '[^A-Za-z0-9_\\-.]'
+# Precompiled at import time, this is on the startup path for every query
+gene_name_disallowed_chars_re = re.compile('[^A-Za-z0-9_\\-.]')
+# A-Za-z, for the format sniff: a line is alphabetic iff deleting these
+# characters leaves nothing
+fasta_alphabet_bytes = bytes(range(65, 91)) + bytes(range(97, 123))
 
 
 class Options(object):
@@ -69,7 +77,12 @@ def main(d_db, infn, opts):
     og_assign = og_assigner.OGAssignDIAMOND(d_db, 
                                             opts.nthreads, 
                                             opts.q_profiles_all)
-    ogs, scores = og_assign.assign(fn_for_use, q_ultra_sens=opts.search_high_sens)
+    # stream the query straight into DIAMOND's stdin so its startup
+    # overlaps the query I/O instead of waiting on a re-read of the file
+    with open(fn_for_use, 'rb') as query_fileobj:
+        ogs, scores = og_assign.assign(fn_for_use,
+                                       q_ultra_sens=opts.search_high_sens,
+                                       query_fileobj=query_fileobj)
     if len(ogs) == 0:
         print("No homologs found for sequence in this database")
         return 
@@ -122,21 +135,35 @@ def main(d_db, infn, opts):
             print("WARNING: " + warn_str) 
             
         q_need_to_print = opts.q_print
+        # Parse the grafted tree once and share it between the size-trim and
+        # the orthologs steps, Newick parsing is expensive for large trees
+        t = None
+        if opts.nU is not None or opts.q_orthologs:
+            t = ete3.Tree(fn_tree)
+            # flatten to arrays once, the walks below are then plain
+            # integer operations rather than ete3 attribute access
+            ft = flat_tree.FlatTree(t)
         if opts.nU is not None:
             # if only nL is specified alone that has no effect
-            t = ete3.Tree(fn_tree)
-            if len(t) > opts.nU:
-                node = t & query_gene
-                while len(node) < opts.nU:
-                    node_prev = node
-                    n_taxa_prev = len(node)
-                    node = node.up
+            if ft.nleaves[-1] > opts.nU:
+                i_node = ft.leaf_index[query_gene_name_final]
+                while ft.nleaves[i_node] < opts.nU:
+                    i_node_prev = i_node
+                    n_taxa_prev = int(ft.nleaves[i_node])
+                    i_node = ft.parent[i_node]
                 # now there are more than nU genes in this tree, step down one
                 # unless it is fewer than nL
-                node = node_prev if (opts.nL is None or n_taxa_prev >= opts.nL) else node
+                i_node = i_node_prev if (opts.nL is None or n_taxa_prev >= opts.nL) else i_node
+                node = ft.nodes[i_node]
+                # only the retained subtree is serialized, written to a
+                # temp file and renamed so fn_tree is never half-written
                 nwk_str = node.write()
-                with open(fn_tree, 'w') as outfile:
+                fn_tree_tmp = fn_tree + ".tmp"
+                with open(fn_tree_tmp, 'w') as outfile:
                     outfile.write(nwk_str)
+                os.replace(fn_tree_tmp, fn_tree)
+                # the written tree is just the pruned subtree, keep the two in step
+                t = node.detach()
                 if q_need_to_print:
                     print(nwk_str)
                     q_need_to_print = False
@@ -147,7 +174,9 @@ def main(d_db, infn, opts):
 
         if opts.q_orthologs:
             fn_ologs = fn_for_use + ".sh.orthologs.tsv"
-            write_orthologs(fn_tree, fn_ologs, query_gene)
+            # node objects survive the trim's detach, the index stays valid
+            write_orthologs(t, fn_ologs, query_gene_name_final,
+                            query_node=ft.nodes[ft.leaf_index[query_gene_name_final]])
  
 
 def is_fasta(infn):
@@ -155,10 +184,11 @@ def is_fasta(infn):
     try:
         if not os.path.exists(infn):
             return False
-        with open(infn, 'r') as infile:
+        with open(infn, 'rb') as infile:
             acc = next(infile)
-            ok = bool(re.match("^>.", acc)) 
-            ok = ok and bool(re.match("^[a-zA-Z]+$", next(infile))) 
+            ok = acc.startswith(b">") and len(acc.rstrip(b"\r\n")) > 1
+            seq = next(infile).rstrip(b"\r\n")
+            ok = ok and bool(seq) and not seq.translate(None, fasta_alphabet_bytes)
     except:
         return False
     return ok
@@ -173,60 +203,124 @@ def clean_fasta(infn):
     Returns:
         fn_for_use - file to use going forward for SHOOT
     """
-    with open(infn, 'r') as infile:
+    with open(infn, 'rb') as infile:
         acc = next(infile)
-        name = acc.rstrip()[1:]
-        name_cleaned = re.sub(gene_name_disallowed_chars_re, '_', name)
+        name = acc.decode().rstrip()[1:]
+        name_cleaned = gene_name_disallowed_chars_re.sub('_', name)
         if name == name_cleaned:
             fn_for_use = infn
         else:
-            # otherwise, need to create a new file
+            # otherwise, need to create a new file. Binary block copy of the
+            # remainder, no point decoding/re-encoding the sequence data
             fn_for_use = infn + ".sh.cleaned"
-            with open(fn_for_use, 'w') as outfile:
-                outfile.write(">%s\n" % name_cleaned)
-                for l in infile:
-                    outfile.write(l)
+            with open(fn_for_use, 'wb') as outfile:
+                outfile.write((">%s\n" % name_cleaned).encode())
+                shutil.copyfileobj(infile, outfile, 1024*1024)
         return fn_for_use, name_cleaned
 
 
+@lru_cache(maxsize=None)
 def gene_to_species(name):
     """
     Convert a gene name to species name
     Args:
         name - gene name
-    Returns 
+    Returns
         species_name - species name
     """
-    return "_".join(name.split("_")[:2])
+    genus, sep, rest = name.partition("_")
+    if not sep:
+        return genus
+    species, _, _ = rest.partition("_")
+    return genus + "_" + species
+
+
+def _name_index(t):
+    """
+    Map leaf name to node, ete3's 't & name' rescans the whole tree per lookup
+    Args:
+        t - ete3.Tree
+    Returns:
+        dict from leaf name to leaf node
+    """
+    return {l.name: l for l in t.iter_leaves()}
 
 
-def write_orthologs(fn_tree, fn_ologs, gene_name):
+def write_orthologs(tree_or_path, fn_ologs, gene_name, query_node=None):
     """
     Write the orthologs of the query gene to file
     Args:
-        fn_tree - filename for the SHOOT tree
+        tree_or_path - pre-loaded ete3.Tree or filename for the SHOOT tree
         fn_ologs - filename to write orthologs
         gene_name - query gene name
+        query_node - the already-resolved leaf for gene_name, if available
     """
-    t = ete3.Tree(fn_tree)
+    if isinstance(tree_or_path, ete3.Tree):
+        t = tree_or_path
+    else:
+        t = ete3.Tree(tree_or_path)
+        query_node = None
+    # Species are mapped to integer ids and each subtree carries a
+    # fixed-width bitset, so the per-ancestor overlap test is a bitwise
+    # AND plus popcount rather than Python set arithmetic. Leaf names and
+    # bitsets are cached per node in one postorder pass, the ancestor walk
+    # below would otherwise re-traverse every sibling subtree it visits
+    species_id = dict()
+    for l in t.iter_leaves():
+        species_id.setdefault(gene_to_species(l.name), len(species_id))
+    species_list = sorted(species_id, key=species_id.get)
+    width = (len(species_id) + 63) // 64
+    for node in t.traverse('postorder'):
+        sbits = np.zeros(width, dtype=np.uint64)
+        if node.is_leaf():
+            node.add_feature('_leaves', [node.name])
+            i = species_id[gene_to_species(node.name)]
+            sbits[i // 64] |= np.uint64(1 << (i % 64))
+        else:
+            node.add_feature('_leaves', [g for c in node.children for g in c._leaves])
+            for c in node.children:
+                sbits |= c._sbits
+        node.add_feature('_sbits', sbits)
     with open(fn_ologs, 'wt') as outfile:
         writer = csv.writer(outfile, delimiter="\t")
         writer.writerow(["Species", "Orthologs"])
-        n = t & gene_name
+        n = query_node if query_node is not None else _name_index(t)[gene_name]
         n_prev = n
-        species_query_branch = set()
+        query_branch_bits = np.zeros(width, dtype=np.uint64)
         while n.up is not None:
             n = n.up
             n_other = [node for node in n.children if node != n_prev]
-            genes_other = [gene for node in n_other for gene in node.get_leaf_names()]
-            species_other = set([gene_to_species(gene) for gene in genes_other])
-            overlap = species_query_branch.intersection(species_other)
-            o = len(overlap)
-            m = min(len(species_other), len(species_query_branch))
+            other_bits = np.zeros(width, dtype=np.uint64)
+            for node in n_other:
+                other_bits |= node._sbits
+            o = _popcount(query_branch_bits & other_bits)
+            m = min(_popcount(other_bits), _popcount(query_branch_bits))
             if o == 0 or (m >= 4 and o == 1) or (m >= 9 and o ==2):
+                genes_other = [gene for node in n_other for gene in node._leaves]
+                overlap = _bitset_to_species(query_branch_bits & other_bits, species_list)
                 add_orthologs_to_file(writer, genes_other, overlap)
             n_prev = n
-            species_query_branch.update(species_other)
+            query_branch_bits |= other_bits
+
+
+def _popcount(bits):
+    """
+    Number of set bits in a uint64 bitset array
+    """
+    return int(np.unpackbits(bits.view(np.uint8)).sum())
+
+
+def _bitset_to_species(bits, species_list):
+    """
+    Decode a bitset back to the set of species names
+    Args:
+        bits - uint64 bitset array
+        species_list - species names indexed by species id
+    Returns:
+        species - set of species names
+    """
+    idx = np.nonzero(np.unpackbits(bits.view(np.uint8), bitorder='little'))[0]
+    return {species_list[i] for i in idx}
 
 
 def add_orthologs_to_file(writer, genes, overlap):
@@ -237,13 +331,13 @@ def add_orthologs_to_file(writer, genes, overlap):
         genes - list of gene names
         overlap - set of species in the overlap (these will not be written)
     """
-    species_to_genes = defaultdict(list)
-    for g in genes:
-        species_to_genes[gene_to_species(g)].append(g)
-    for sp in sorted(species_to_genes.keys()):
+    # sort once by species then group, the stable sort keeps genes in
+    # their original order within each species
+    genes_sorted = sorted(genes, key=gene_to_species)
+    for sp, sp_genes in itertools.groupby(genes_sorted, key=gene_to_species):
         if sp in overlap:
             continue
-        writer.writerow([sp, ", ".join(species_to_genes[sp])])
+        writer.writerow([sp, ", ".join(sp_genes)])
 
 
 def clean_dir_name(dname):
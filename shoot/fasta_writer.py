@@ -50,6 +50,25 @@ class FastaWriter(object):
                 else:
                     sys.stderr.write("ERROR: %s not found\n" % seq)
     
+    def WriteSeqsToFasta_batch(self, seqs, outFilename, idDict=None):
+        """
+        Write the sequences with a single buffered write rather than one
+        write call per gene
+        Args:
+            seqs - accessions to write, in order
+            outFilename - output filename
+            idDict - optional dict to rename accessions on output
+        """
+        out = []
+        for seq in seqs:
+            if seq in self.SeqLists:
+                name = seq if idDict is None else idDict[seq]
+                out.append(">%s\n%s" % (name, self.SeqLists[seq]))
+            else:
+                sys.stderr.write("ERROR: %s not found\n" % seq)
+        with open(outFilename, 'w') as outFile:
+            outFile.write("".join(out))
+
     def AppendToStockholm(self, msa_id, outFilename, seqs=None):
         """
         Append the msa to a stockholm format file. File must already be aligned
@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Flat, array-based view of an ete3 tree for the hot traversal loops.
+ete3 stores each node as a full Python object, so climbing a large tree
+attribute-by-attribute is expensive; the arrays here make ancestor walks
+and subtree-size lookups plain integer operations. ete3 is still used
+for reading and writing Newick.
+"""
+
+import numpy as np
+
+
+class FlatTree(object):
+    """
+    Parent-array representation of a tree
+    Attributes:
+        nodes - ete3 node for each index, in postorder (root is last)
+        parent - np.int32 array, index of each node's parent, -1 for the root
+        nleaves - np.int32 array, number of leaves below each node
+        leaf_index - dict from leaf name to node index
+    """
+    def __init__(self, t):
+        """
+        Flatten a tree in a single postorder pass
+        Args:
+            t - ete3.Tree
+        """
+        self.nodes = []
+        index = dict()
+        for n in t.traverse('postorder'):
+            index[n] = len(self.nodes)
+            self.nodes.append(n)
+        n_nodes = len(self.nodes)
+        self.parent = np.full(n_nodes, -1, dtype=np.int32)
+        self.nleaves = np.zeros(n_nodes, dtype=np.int32)
+        self.leaf_index = dict()
+        for i, n in enumerate(self.nodes):
+            if n.up is not None:
+                self.parent[i] = index[n.up]
+            if n.is_leaf():
+                self.nleaves[i] = 1
+                self.leaf_index[n.name] = i
+            else:
+                self.nleaves[i] = sum(self.nleaves[index[c]] for c in n.children)
@@ -35,11 +35,13 @@ class OGAssignDIAMOND(OGAssigner):
         self.profiles_db_name = "diamond_profile_sequences.fa.db.dmnd"
         self.all_seqs_db_name = "diamond_all_sequences.fa.db.dmnd"
 
-    def assign(self, infn, q_ultra_sens=False):
+    def assign(self, infn, q_ultra_sens=False, query_fileobj=None):
         """
         Assign a sequence to an orthogroup
         Args:
             infn - Input FASTA filename
+            query_fileobj - optional open file for the query, streamed to
+                            DIAMOND's stdin instead of it re-reading infn
         Returns
             iogs - List[index of OG]
             scores - List[e-values]
@@ -49,30 +51,35 @@ class OGAssignDIAMOND(OGAssigner):
             fn_base = infn.replace(ext_cleaned, "")
         else:
             fn_base = infn
-        fn_results = self.run_diamond(infn, fn_base, q_ultra_sens=q_ultra_sens)
+        fn_results = self.run_diamond(infn, fn_base, q_ultra_sens=q_ultra_sens, query_fileobj=query_fileobj)
         ogs, scores = self.og_from_diamond_results(fn_results)
         if ((not q_ultra_sens) or (not self.q_all_seqs_default)) and len(ogs) == 0:
-            # Try again with a more sensitive search & all sequences
+            # Try again with a more sensitive search & all sequences.
+            # The stream was consumed by the first run, re-read from disk
             fn_results = self.run_diamond(infn, fn_base, q_ultra_sens=True, q_all_seqs=True)
             ogs, scores = self.og_from_diamond_results(fn_results)
         return ogs, scores
-    
-    def run_diamond(self, fn_query, fn_out_base, q_ultra_sens=False, q_all_seqs=False):
+
+    def run_diamond(self, fn_query, fn_out_base, q_ultra_sens=False, q_all_seqs=False, query_fileobj=None):
         """
         Run DIAMOND against database of orthogroup profiles
         Args:
             fn_query - input query FASTA filename
             fn_out_base - base filename on which to create internal filenames
+            query_fileobj - optional open file for the query, fed to stdin
         Returns:
             fn_og_results_out - DIAMOND results filename
         """
-        fn_db = self.d_db + (self.all_seqs_db_name if q_all_seqs else self.profiles_db_name) 
+        fn_db = self.d_db + (self.all_seqs_db_name if q_all_seqs else self.profiles_db_name)
         fn_og_results_out = fn_out_base + ".sh.ogs.txt"
         with open(os.devnull, 'w') as FNULL:
-            cmd_list = ["diamond", "blastp", "-d", fn_db, "-q", fn_query, "-o", fn_og_results_out, "--quiet", "-e", "0.001", "--compress", "1", "-p", str(self.nthreads)]
+            cmd_list = ["diamond", "blastp", "-d", fn_db, "-o", fn_og_results_out, "--quiet", "-e", "0.001", "--compress", "1", "-p", str(self.nthreads)]
+            if query_fileobj is None:
+                # DIAMOND reads the query from stdin when -q is omitted
+                cmd_list += ["-q", fn_query]
             if q_ultra_sens:
                 cmd_list += ["--ultra-sensitive"]
-            subprocess.call(cmd_list,stdout=FNULL, stderr=FNULL)
+            subprocess.call(cmd_list, stdin=query_fileobj, stdout=FNULL, stderr=FNULL)
         return fn_og_results_out + ".gz"
 
     @staticmethod
@@ -7,13 +7,35 @@ For the SHOOT database rooted trees are required (i.e. Gene_Tree/ directory of O
 so translate these back to OrthoFinder IDs using the -w option
 
 """
-import os 
+import os
 import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import ete3
+import numpy as np
 
 import fasta_writer
 
+
+def pairwise_distance(a, b):
+    """
+    Distance between two nodes using memoized root-to-node distances
+    Args:
+        a, b - nodes carrying the '_rootd' feature
+    Returns:
+        d - distance along the tree between a and b
+    """
+    ancestors = set()
+    n = a
+    while n is not None:
+        ancestors.add(n)
+        n = n.up
+    n = b
+    while n not in ancestors:
+        n = n.up
+    return a._rootd + b._rootd - 2*n._rootd
+
+
 def split_tree(fn_tree, fn_msa, n_taxa, q_outgroup):
     """
     Split a tree into smaller subtrees
@@ -32,8 +54,15 @@ def split_tree(fn_tree, fn_msa, n_taxa, q_outgroup):
     fw = fasta_writer.FastaWriter(fn_msa)
     if q_outgroup:
         # work out number of gaps for each gene - cheap measure of what's best
-        # to use as the outgroup gene
-        d_ngaps = {name:seq.count("-") for name, seq in fw.SeqLists.items()}
+        # to use as the outgroup gene. One NumPy reduction over the
+        # concatenated sequences rather than a Python-level count per gene
+        names = list(fw.SeqLists.keys())
+        seqs = [fw.SeqLists[name].encode() for name in names]
+        buf = np.frombuffer(b"".join(seqs), dtype=np.uint8)
+        lens = np.array([len(s) for s in seqs], dtype=np.int64)
+        ends = np.cumsum(lens)
+        cum_gaps = np.concatenate(([0], np.cumsum(buf == ord('-'))))
+        d_ngaps = dict(zip(names, (cum_gaps[ends] - cum_gaps[ends - lens]).tolist()))
     n_profile = 0
     d, fn = os.path.split(fn_tree)
     if d == "":
@@ -42,9 +71,10 @@ def split_tree(fn_tree, fn_msa, n_taxa, q_outgroup):
     d_out_sup = dout_main + "super/"
     d_out_sub = dout_main + "sub/"
     d_out_msa_sub = dout_main + "msa_sub/"
-    for d_to_make in [dout_main, d_out_sup, d_out_sub, d_out_msa_sub]:
-        if not os.path.exists(d_to_make):
-            os.mkdir(d_to_make)
+    # makedirs creates dout_main along with each subdirectory, no need for
+    # the exists checks
+    for d_to_make in [d_out_sup, d_out_sub, d_out_msa_sub]:
+        os.makedirs(d_to_make, exist_ok=True)
     t = ete3.Tree(fn_tree)
     fn_og_part = fn.split("_")[0]
     fn_out_pat = d_out_sub + fn_og_part + ".%d.tre"      # with outgroup  
@@ -64,6 +94,15 @@ def split_tree(fn_tree, fn_msa, n_taxa, q_outgroup):
         for g in all_genes_in_tree.difference(all_genes_in_msa):
             print(g)
         t.prune(all_genes_in_msa)
+    # Memoize leaf names and root-to-node distances in single passes,
+    # get_leaf_names/get_distance re-walk the tree on every call
+    leaf_by_name = dict()
+    for n in t.traverse('postorder'):
+        n.add_feature('_leaves', [n.name] if n.is_leaf() else [x for c in n.children for x in c._leaves])
+        if n.is_leaf():
+            leaf_by_name[n.name] = n
+    for n in t.traverse('preorder'):
+        n.add_feature('_rootd', 0. if n.up is None else n.up._rootd + n.dist)
     sizes = []
     stop_fn = lambda node : len(node) <= n_taxa
     for n in t.traverse("preorder", is_leaf_fn = stop_fn):
@@ -77,34 +116,37 @@ def split_tree(fn_tree, fn_msa, n_taxa, q_outgroup):
             n_profile += min(5, l)
             if not q_outgroup:
                 nwk = n.write(outfile)
-                fw.WriteSeqsToFasta(n.get_leaf_names(), fn_out_msa_pat % i_part)
-            else:    
+                fw.WriteSeqsToFasta_batch(n._leaves, fn_out_msa_pat % i_part)
+            else:
                 # go to sister clade, pick gene with fewest gaps
                 sisters = [s for s in n.up.children if s != n]
-                sister_genes = [g for s in sisters for g in s.get_leaf_names()]
-                n_gaps = [9e99 if g.startswith("PART.") else d_ngaps[g] for g in sister_genes]
-                x = min(n_gaps)
-                i = n_gaps.index(x)   # doesn't matter if there is a tie, any will do
-                outgrp = sister_genes[i]
-                d = n.get_distance(outgrp)
-                if not (d > n.dist):
-                    print(([n, ], sisters))
-                    print((n.get_leaf_names()[0], outgrp))
-                    print((n.dist, d))
-                assert(d > n.dist)
+                sister_genes = [g for s in sisters for g in s._leaves]
+                # single pass, in a tie any of the genes will do (min takes the first)
+                outgrp = min(sister_genes,
+                             key=lambda g: 9e99 if g.startswith("PART.") else d_ngaps[g])
+                d = pairwise_distance(n, leaf_by_name[outgrp])
+                assert d > n.dist, (n._leaves[0], outgrp, n.dist, d)
                 n.write(outfile=fn_out_pat_without % i_part)
                 nwk = n.write()
                 nwk = "(" + nwk[:-1] + ",SHOOTOUTGROUP_%s:%0.5f);" % (outgrp, d-n.dist)
-                genes = n.get_leaf_names()
+                genes = list(n._leaves)
                 translate = {g:g for g in genes}
                 translate[outgrp] = "SHOOTOUTGROUP_" + outgrp
                 genes = [outgrp, ] + genes
-                fw.WriteSeqsToFasta_withNewAccessions(genes, fn_out_msa_pat % i_part, translate)
+                fw.WriteSeqsToFasta_batch(genes, fn_out_msa_pat % i_part, translate)
             with open(fn_out_pat % i_part, 'w') as outfile:
                 outfile.write(nwk + "\n")
+            # build the unrooted copy from the live node rather than
+            # re-parsing the Newick string that was just written
+            t_sub = n.copy()
+            if q_outgroup:
+                new_root = ete3.Tree()
+                new_root.dist = 0.0
+                new_root.add_child(t_sub)
+                new_root.add_child(name="SHOOTOUTGROUP_" + outgrp, dist=d-n.dist)
+                t_sub = new_root
             n.name = "PART.%d" % i_part
             sizes.append(l)
-            t_sub = ete3.Tree(nwk)
             if len(t_sub) >= 3:
                 t_sub.unroot()
             t_sub.write(outfile = (fn_out_pat % i_part) + ".unroot.tre")
@@ -133,10 +175,14 @@ def count_profiles():
     fn_msa_pat = d + "MultipleSequenceAlignments/OG%07d.fa"
     n_trees = 17125
     n_profiles = 0
-    for i in range(n_trees):
-        if i % 100 == 0:
-            print(i)
-        n_profiles += split_tree(fn_tree_pat % i, fn_msa_pat % i, n_target_taxa)
+    # trees are independent of one another, farm them out across the cores
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as ex:
+        futs = [ex.submit(split_tree, fn_tree_pat % i, fn_msa_pat % i, n_target_taxa, True)
+                for i in range(n_trees)]
+        for n_done, fut in enumerate(as_completed(futs)):
+            if n_done % 100 == 0:
+                print(n_done)
+            n_profiles += fut.result()
     print("%d profile sequences required" % n_profiles)
 
 if __name__ == "__main__":